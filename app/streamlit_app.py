@@ -1,5 +1,6 @@
 import os
 import json
+import hashlib
 from datetime import datetime, timezone
 import sys
 from pathlib import Path
@@ -14,8 +15,10 @@ import streamlit as st
 from dotenv import load_dotenv
 from google import genai
 
+from src.label_batch import CACHE_TTL_SECONDS, TEMPERATURE, create_prompt_cache, label_one_batch
 from src.prompts import build_system_instruction
-from src.schemas import make_response_schema, BatchResponse, LabeledRequest
+from src.schemas import make_response_schema
+from src.utils import BatchQueue, load_csv_cached, normalize_str_cols
 
 st.set_page_config(page_title="AI Maintenance Ticket Assistant Demo", layout="centered")
 st.title("AI Maintenance Ticket Assistant")
@@ -27,11 +30,12 @@ st.info(
 load_dotenv()
 api_key = os.environ.get("GEMINI_API_KEY")
 
-MODEL = "gemini-2.5-flash"
 DEMO_EXAMPLES_PATH = Path("data/outputs/demo_examples.csv")
 PREDICTIONS_PATH = Path("data/outputs/predictions.csv")
 MODE_TYPED = "Type my own request"
 MODE_EXAMPLES = "Choose from 30 real examples"
+BATCH_MAX_WAIT_MS = 250
+BATCH_MAX_ITEMS = 20
 
 client = genai.Client(api_key=api_key) if api_key else None
 
@@ -48,11 +52,10 @@ def word_count(text: str) -> int:
     return len([w for w in (text or "").strip().split() if w])
 
 @st.cache_data(show_spinner=False)
-def load_demo_examples() -> pd.DataFrame | None:
+def load_demo_examples() -> tuple[pd.DataFrame, dict[int, dict]] | None:
     if not DEMO_EXAMPLES_PATH.exists():
         return None
 
-    demo_df = pd.read_csv(DEMO_EXAMPLES_PATH)
     required_cols = [
         "id",
         "resident_selected_priority",
@@ -62,73 +65,106 @@ def load_demo_examples() -> pd.DataFrame | None:
         "ai_service_category",
         "suggested_actions",
     ]
-    if not set(required_cols).issubset(demo_df.columns):
+    try:
+        demo_df = load_csv_cached(str(DEMO_EXAMPLES_PATH), usecols=required_cols)
+    except KeyError:
         return None
 
-    demo_df = demo_df[required_cols].copy()
     demo_df["id"] = pd.to_numeric(demo_df["id"], errors="coerce")
     demo_df = demo_df.dropna(subset=["id"]).copy()
     demo_df["id"] = demo_df["id"].astype(int)
-    for col in required_cols[1:]:
-        demo_df[col] = demo_df[col].fillna("").astype(str).str.strip()
+    demo_df = normalize_str_cols(demo_df, required_cols[1:])
     demo_df = demo_df.drop_duplicates(subset=["id"], keep="last")
-    return demo_df
+    demo_dict = {int(r.id): r._asdict() for r in demo_df.itertuples(index=False)}
+    return demo_df, demo_dict
 
 @st.cache_data(show_spinner=False)
 def load_allowed_labels() -> tuple[list[str], list[str]] | None:
     if not PREDICTIONS_PATH.exists():
         return None
 
-    pred_df = pd.read_csv(PREDICTIONS_PATH)
-    required_cols = ["Priority", "Service_Category"]
-    if not set(required_cols).issubset(pred_df.columns):
+    try:
+        pred_df = load_csv_cached(str(PREDICTIONS_PATH), usecols=["Priority", "Service_Category"])
+    except KeyError:
         return None
 
-    priorities = sorted(
-        pred_df["Priority"].fillna("").astype(str).str.strip().replace("", pd.NA).dropna().unique().tolist()
-    )
-    categories = sorted(
-        pred_df["Service_Category"].fillna("").astype(str).str.strip().replace("", pd.NA).dropna().unique().tolist()
-    )
+    pred_df = normalize_str_cols(pred_df, ["Priority", "Service_Category"])
+    priorities = sorted(pred_df["Priority"].replace("", pd.NA).dropna().unique().tolist())
+    categories = sorted(pred_df["Service_Category"].replace("", pd.NA).dropna().unique().tolist())
     if not priorities or not categories:
         return None
     return priorities, categories
 
-def make_example_label(row: pd.Series) -> str:
-    snippet = row["comment"]
-    snippet = (snippet[:90] + "…") if len(snippet) > 90 else snippet
+@st.cache_resource(show_spinner=False)
+def load_llm_config(priorities: tuple[str, ...], categories: tuple[str, ...]) -> tuple[dict, str]:
+    # Shared across sessions; callers must treat the returned schema as read-only.
+    schema = make_response_schema(list(priorities), list(categories))
+    system_instruction = build_system_instruction(list(priorities), list(categories))
+    return schema, system_instruction
+
+@st.cache_resource(show_spinner=False)
+def get_batch_queue() -> BatchQueue:
+    # One queue per server process, so concurrent sessions share Gemini calls.
+    return BatchQueue(max_wait_ms=BATCH_MAX_WAIT_MS, max_batch=BATCH_MAX_ITEMS)
+
+# Refresh a little before the server-side cache expires.
+@st.cache_resource(show_spinner=False, ttl=CACHE_TTL_SECONDS - 300)
+def get_prompt_cache(system_instruction: str) -> str | None:
+    return create_prompt_cache(client, system_instruction)
+
+def run_triage(priority: str, category: str, comment: str, ts: str) -> tuple[str, str, str]:
+    # Created on the first typed submit, so example mode never touches the network.
+    prompt_cache_name = get_prompt_cache(system_instruction)
+    batch_queue = get_batch_queue()
+    item = {
+        "id": batch_queue.next_id(),
+        "ts": ts,
+        "resident_selected_priority": priority,
+        "resident_selected_category": category,
+        "comment": comment,
+    }
+
+    def flush_batch(items: list[dict]) -> dict[int, dict]:
+        records = label_one_batch(client, items, schema, system_instruction, prompt_cache_name, strict=True)
+        return {r["id"]: r for r in records}
+
+    out = batch_queue.submit(item, flush_batch)
+    return out["Priority"], out["Service_Category"], out["Suggested_Actions"]
+
+# Repeat submits of the same (normalized) request skip Gemini. Underscored args
+# are left out of the cache key: the model sees the raw text and request time.
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=256)
+def triage(priority: str, category: str, comment_norm: str, labels_hash: str,
+           _comment: str, _ts: str) -> tuple[str, str, str]:
+    return run_triage(priority, category, _comment, _ts)
+
+def make_example_labels(demo_df: pd.DataFrame) -> list[str]:
+    comment = demo_df["comment"]
+    snippet = comment.str.slice(0, 90).where(comment.str.len() <= 90, comment.str.slice(0, 90) + "…")
     return (
-        f'#{int(row["id"])} | {row["resident_selected_priority"]} | '
-        f'{row["resident_selected_category"]} | {snippet}'
-    )
+        "#" + demo_df["id"].astype(str) + " | " + demo_df["resident_selected_priority"] + " | "
+        + demo_df["resident_selected_category"] + " | " + snippet
+    ).tolist()
+
+@st.cache_data(show_spinner=False)
+def build_example_index(demo_df: pd.DataFrame) -> tuple[tuple[str, ...], dict[str, int]]:
+    id_by_label = dict(zip(make_example_labels(demo_df), demo_df["id"].tolist()))
+    return tuple(id_by_label), id_by_label
 
 # Load deploy-time artifacts for labels and examples
-demo_examples_df = load_demo_examples()
-demo_by_id = demo_examples_df.set_index("id") if demo_examples_df is not None else None
+demo_source = load_demo_examples()
+demo_examples_df, demo_dict = demo_source if demo_source is not None else (None, None)
 
 label_source = load_allowed_labels()
 if label_source is not None:
     allowed_priorities, allowed_categories = label_source
 elif demo_examples_df is not None and not demo_examples_df.empty:
+    # load_demo_examples already normalized these columns.
     allowed_priorities = sorted(
-        demo_examples_df["resident_selected_priority"]
-        .fillna("")
-        .astype(str)
-        .str.strip()
-        .replace("", pd.NA)
-        .dropna()
-        .unique()
-        .tolist()
+        demo_examples_df["resident_selected_priority"].replace("", pd.NA).dropna().unique().tolist()
     )
     allowed_categories = sorted(
-        demo_examples_df["resident_selected_category"]
-        .fillna("")
-        .astype(str)
-        .str.strip()
-        .replace("", pd.NA)
-        .dropna()
-        .unique()
-        .tolist()
+        demo_examples_df["resident_selected_category"].replace("", pd.NA).dropna().unique().tolist()
     )
 else:
     st.error(
@@ -137,6 +173,11 @@ else:
     )
     st.stop()
 
+schema, system_instruction = load_llm_config(tuple(allowed_priorities), tuple(allowed_categories))
+labels_hash = hashlib.blake2b(
+    json.dumps([allowed_priorities, allowed_categories]).encode(), digest_size=8
+).hexdigest()
+
 
 # UI: portal form
 st.subheader("Submit a Service Request")
@@ -186,16 +227,15 @@ else:
             "Run `python -m src.build_demo_examples` first."
         )
     else:
-        labels = [make_example_label(r) for _, r in demo_examples_df.iterrows()]
-        label_to_row = {labels[i]: demo_examples_df.iloc[i] for i in range(len(labels))}
+        labels, id_by_label = build_example_index(demo_examples_df)
 
         chosen = st.selectbox("Pick a real example", labels, index=0)
-        row = label_to_row[chosen]
+        selected_example_id = id_by_label[chosen]
+        row = demo_dict[selected_example_id]
 
         selected_priority = str(row["resident_selected_priority"])
         selected_category = str(row["resident_selected_category"])
         comment_text = str(row["comment"])
-        selected_example_id = int(row["id"])
 
         ex_col1, ex_col2 = st.columns(2)
         with ex_col1:
@@ -213,54 +253,39 @@ can_submit = bool(comment_text.strip()) and (word_count(comment_text) <= 100)
 if mode == MODE_TYPED:
     can_submit = can_submit and (client is not None)
 else:
-    can_submit = can_submit and (demo_by_id is not None)
+    can_submit = can_submit and (demo_dict is not None)
 
 st.divider()
 if st.button("Submit & Let AI Re-triage", disabled=not can_submit):
-    out = None
     if is_example_mode:
-        if demo_by_id is None:
+        if demo_dict is None:
             st.error(
                 "Missing or invalid `data/outputs/demo_examples.csv` for example mode. "
                 "Run `python -m src.build_demo_examples` first."
             )
             st.stop()
-        if selected_example_id is None or selected_example_id not in demo_by_id.index:
+        if selected_example_id is None or selected_example_id not in demo_dict:
             st.error(f"No cached prediction found for example id #{selected_example_id}.")
             st.stop()
 
-        cached = demo_by_id.loc[selected_example_id]
-        out = LabeledRequest(
-            id=selected_example_id,
-            Priority=str(cached["ai_priority"]),
-            Service_Category=str(cached["ai_service_category"]),
-            Suggested_Actions=str(cached["suggested_actions"]),
-        )
+        cached = demo_dict[selected_example_id]
+        ai_priority = str(cached["ai_priority"])
+        ai_category = str(cached["ai_service_category"])
+        ai_actions = str(cached["suggested_actions"])
     else:
-        # Build input payload
-        schema = make_response_schema(allowed_priorities, allowed_categories)
-        system_instruction = build_system_instruction(allowed_priorities, allowed_categories)
-        payload = [{
-            "id": 1,  # demo id
-            "ts": request_time_iso,
-            "resident_selected_priority": selected_priority,
-            "resident_selected_category": selected_category,
-            "comment": comment_text.strip(),
-        }]
-
-        contents = system_instruction + "\n\n" + "INPUT_ITEMS_JSON:\n" + json.dumps(payload, ensure_ascii=False)
-
+        comment = comment_text.strip()
         with st.spinner("Calling Gemini..."):
-            resp = client.models.generate_content(
-                model=MODEL,
-                contents=contents,
-                config={
-                    "response_mime_type": "application/json",
-                    "response_json_schema": schema,
-                    "temperature": 0,
-                },
-            )
-            out = BatchResponse.model_validate_json(resp.text).results[0]
+            if TEMPERATURE > 0:
+                # Sampled outputs vary per call, so don't serve them from cache.
+                ai_priority, ai_category, ai_actions = run_triage(
+                    selected_priority, selected_category, comment, request_time_iso
+                )
+            else:
+                comment_norm = " ".join(comment.lower().split())
+                ai_priority, ai_category, ai_actions = triage(
+                    selected_priority, selected_category, comment_norm, labels_hash,
+                    comment, request_time_iso,
+                )
 
     st.subheader("AI Re-triage Result")
     before_col, after_col = st.columns(2)
@@ -270,8 +295,8 @@ if st.button("Submit & Let AI Re-triage", disabled=not can_submit):
         st.markdown(f"- Category: `{selected_category}`")
     with after_col:
         st.markdown("**AI re-triage**")
-        st.markdown(f"- Priority: `{out.Priority}`")
-        st.markdown(f"- Category: `{out.Service_Category}`")
+        st.markdown(f"- Priority: `{ai_priority}`")
+        st.markdown(f"- Category: `{ai_category}`")
 
     st.subheader("Message to Resident")
-    st.info(out.Suggested_Actions)
+    st.info(ai_actions)
@@ -1,10 +1,12 @@
 from __future__ import annotations
 
-from collections import Counter, defaultdict
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+from .utils import load_csv_cached, normalize_str_cols
+
 
 SAMPLE_PATH = Path("data/processed/service_requests_sample_1000.csv")
 PREDICTIONS_PATH = Path("data/outputs/predictions.csv")
@@ -77,31 +79,33 @@ def build_example_set(df: pd.DataFrame, n: int = N_EXAMPLES, seed: int = SEED) -
         return df
 
     n = min(n, len(df))
-    rng = df.sample(frac=1, random_state=seed).reset_index(drop=True).copy()
-    rng["_order"] = rng.index
+    rng = df.sample(frac=1, random_state=seed).reset_index(drop=True)
 
     targets = _compute_priority_targets(rng, n, "resident_selected_priority")
     priorities = sorted(targets.keys())
 
-    selected_rows = []
-    selected_ids: set[int] = set()
-    global_cat_counts: Counter[str] = Counter()
-    prio_cat_counts: dict[str, Counter[str]] = defaultdict(Counter)
-    seen_categories: set[str] = set()
+    # Integer-code the categories once so per-pick scoring is pure NumPy.
+    cat_codes, cats = pd.factorize(rng["resident_selected_category"], use_na_sentinel=False)
+    prio_masks = [(rng["resident_selected_priority"] == p).to_numpy() for p in priorities]
+    global_cat = np.zeros(len(cats), dtype=np.int64)
+    prio_cat = np.zeros((len(priorities), len(cats)), dtype=np.int64)
+    # Multipliers larger than any count, so the score orders like the rank tuple.
+    k = len(rng) + 1
+
+    out_cols = list(df.columns)
+    selected_rows: list[dict] = []
+    selected_mask = np.zeros(len(rng), dtype=bool)
     remaining = targets.copy()
 
     # Round-robin by priority to enforce quota balance.
     while sum(remaining.values()) > 0:
         made_pick = False
-        for priority in priorities:
+        for p, priority in enumerate(priorities):
             if remaining.get(priority, 0) <= 0:
                 continue
 
-            candidates = rng[
-                (rng["resident_selected_priority"] == priority)
-                & (~rng["id"].isin(selected_ids))
-            ].copy()
-            if candidates.empty:
+            candidate_idx = np.where(prio_masks[p] & ~selected_mask)[0]
+            if candidate_idx.size == 0:
                 remaining[priority] = 0
                 continue
 
@@ -109,49 +113,39 @@ def build_example_set(df: pd.DataFrame, n: int = N_EXAMPLES, seed: int = SEED) -
             # 1) prefer unseen categories
             # 2) then categories seen least globally
             # 3) then categories seen least within this priority
-            candidates["_unseen_rank"] = candidates["resident_selected_category"].map(
-                lambda c: 0 if c not in seen_categories else 1
-            )
-            candidates["_global_cat_rank"] = candidates["resident_selected_category"].map(
-                lambda c: global_cat_counts.get(c, 0)
-            )
-            candidates["_prio_cat_rank"] = candidates["resident_selected_category"].map(
-                lambda c: prio_cat_counts[priority].get(c, 0)
-            )
-
-            row = candidates.sort_values(
-                ["_unseen_rank", "_global_cat_rank", "_prio_cat_rank", "_order"]
-            ).iloc[0]
-
-            selected_rows.append(row.drop(labels=["_unseen_rank", "_global_cat_rank", "_prio_cat_rank"]))
-            selected_id = int(row["id"])
-            selected_category = str(row["resident_selected_category"])
-
-            selected_ids.add(selected_id)
+            # candidate_idx is ascending, so argmin's first minimum breaks ties by shuffled order.
+            codes = cat_codes[candidate_idx]
+            cat_global = global_cat[codes]
+            score = (cat_global > 0) * (k * k) + cat_global * k + prio_cat[p, codes]
+            pos = int(candidate_idx[np.argmin(score)])
+
+            selected_rows.append(rng.iloc[pos].to_dict())
+            code = cat_codes[pos]
+
+            selected_mask[pos] = True
             remaining[priority] -= 1
-            global_cat_counts[selected_category] += 1
-            prio_cat_counts[priority][selected_category] += 1
-            seen_categories.add(selected_category)
+            global_cat[code] += 1
+            prio_cat[p, code] += 1
             made_pick = True
 
         if not made_pick:
             break
 
-    picked = pd.DataFrame(selected_rows).drop(columns=["_order"], errors="ignore")
-
     # Safety fallback: if quotas couldn't fill all rows, top up by category diversity.
-    if len(picked) < n:
-        need = n - len(picked)
-        remaining_rows = rng[~rng["id"].isin(selected_ids)].copy()
-        if not remaining_rows.empty:
-            remaining_rows["_global_cat_rank"] = remaining_rows["resident_selected_category"].map(
-                lambda c: global_cat_counts.get(c, 0)
-            )
-            top_up = remaining_rows.sort_values(
-                ["_global_cat_rank", "_order"]
-            ).head(need).drop(columns=["_global_cat_rank", "_order"], errors="ignore")
-            picked = pd.concat([picked, top_up], ignore_index=True)
-
+    if len(selected_rows) < n:
+        need = n - len(selected_rows)
+        remaining_idx = np.where(~selected_mask)[0]
+        if remaining_idx.size > 0:
+            # Least-seen category first, then shuffled order; only the best `need` are sorted.
+            score = global_cat[cat_codes[remaining_idx]] * k + remaining_idx
+            if need < score.size:
+                best = np.argpartition(score, need - 1)[:need]
+            else:
+                best = np.arange(score.size)
+            top_up_idx = remaining_idx[best[np.argsort(score[best])]]
+            selected_rows.extend(rng.iloc[top_up_idx].to_dict("records"))
+
+    picked = pd.DataFrame(selected_rows, columns=out_cols)
     picked = picked.sample(frac=1, random_state=seed).reset_index(drop=True)
     return picked.head(n)
 
@@ -162,8 +156,8 @@ def main() -> None:
     if not PREDICTIONS_PATH.exists():
         raise FileNotFoundError(f"Missing predictions file: {PREDICTIONS_PATH}")
 
-    sample_df = pd.read_csv(SAMPLE_PATH)
-    predictions_df = pd.read_csv(PREDICTIONS_PATH)
+    sample_df = load_csv_cached(str(SAMPLE_PATH))
+    predictions_df = load_csv_cached(str(PREDICTIONS_PATH))
 
     sample_required = {"id", "Priority", "Service Category", "Service Comments"}
     pred_required = {"id", "Priority", "Service_Category", "Suggested_Actions"}
@@ -185,13 +179,9 @@ def main() -> None:
     sample_df["id"] = pd.to_numeric(sample_df["id"], errors="coerce")
     sample_df = sample_df.dropna(subset=["id"]).copy()
     sample_df["id"] = sample_df["id"].astype(int)
-    sample_df["resident_selected_priority"] = (
-        sample_df["resident_selected_priority"].fillna("").astype(str).str.strip()
-    )
-    sample_df["resident_selected_category"] = (
-        sample_df["resident_selected_category"].fillna("").astype(str).str.strip()
+    sample_df = normalize_str_cols(
+        sample_df, ["resident_selected_priority", "resident_selected_category", "comment"]
     )
-    sample_df["comment"] = sample_df["comment"].fillna("").astype(str).str.strip()
 
     predictions_df = predictions_df.rename(
         columns={
@@ -204,12 +194,8 @@ def main() -> None:
     predictions_df["id"] = pd.to_numeric(predictions_df["id"], errors="coerce")
     predictions_df = predictions_df.dropna(subset=["id"]).copy()
     predictions_df["id"] = predictions_df["id"].astype(int)
-    predictions_df["ai_priority"] = predictions_df["ai_priority"].fillna("").astype(str).str.strip()
-    predictions_df["ai_service_category"] = (
-        predictions_df["ai_service_category"].fillna("").astype(str).str.strip()
-    )
-    predictions_df["suggested_actions"] = (
-        predictions_df["suggested_actions"].fillna("").astype(str).str.strip()
+    predictions_df = normalize_str_cols(
+        predictions_df, ["ai_priority", "ai_service_category", "suggested_actions"]
     )
     predictions_df = predictions_df.drop_duplicates(subset=["id"], keep="last")
 
@@ -1,15 +1,18 @@
 from __future__ import annotations
 import os
 import json
+import asyncio
+import argparse
 from pathlib import Path
+from typing import BinaryIO
 
-import pandas as pd
 from dotenv import load_dotenv
 from tqdm import tqdm
 from google import genai
 
-from .utils import load_csv, clean_text, ensure_dir, chunked, RateLimiter, read_done_ids, append_jsonl
-from .schemas import BatchResponse, make_response_schema
+from .utils import (load_csv_cached, clean_text, ensure_dir, chunked, RateLimiter, read_done_ids,
+                    append_jsonl, append_csv, rebuild_csv_from_jsonl)
+from .schemas import RESULTS_ADAPTER, LabeledRequest, make_response_schema
 from .prompts import build_system_instruction, build_user_contents
 
 DATA = Path("data/processed/service_requests_sample_1000.csv")
@@ -20,28 +23,155 @@ PRED_JSONL = OUT_DIR / "predictions.jsonl"
 RPM_SLEEP_SECONDS = 13.0
 DAILY_CALL_CAP = 20
 BATCH_SIZE = 50
+MAX_CONCURRENCY = 4
 MODEL = "gemini-2.5-flash"
+TEMPERATURE = 0
+CACHE_TTL_SECONDS = 3600
+MIN_CACHE_TOKENS = 1024  # explicit caching minimum for gemini-2.5-flash
+PRED_FIELDS = list(LabeledRequest.model_fields)
 
 def gemini_client(api_key: str) -> genai.Client:
     return genai.Client(api_key=api_key)
 
-def label_one_batch(client: genai.Client, batch_items: list[dict], schema: dict,
-                    system_instruction: str) -> BatchResponse:
-    user_contents = build_user_contents(json.dumps(batch_items, ensure_ascii=False))
-    contents = system_instruction + "\n\n" + user_contents
+def create_prompt_cache(client: genai.Client, system_instruction: str) -> str | None:
+    """
+    Cache the invariant system instruction server-side so calls skip its prefill.
+    Returns None when the prompt is below the model's caching minimum or the cache
+    can't be created for any reason; calls then send the instruction inline, which
+    still benefits from Gemini's implicit prefix caching.
+    """
+    try:
+        n_tokens = client.models.count_tokens(model=MODEL, contents=system_instruction).total_tokens
+        if (n_tokens or 0) < MIN_CACHE_TOKENS:
+            return None
+        cache = client.caches.create(
+            model=MODEL,
+            config={"system_instruction": system_instruction, "ttl": f"{CACHE_TTL_SECONDS}s"},
+        )
+    except Exception:
+        return None
+    return cache.name
+
+def delete_prompt_cache(client: genai.Client, cache_name: str | None) -> None:
+    if cache_name is None:
+        return
+    try:
+        client.caches.delete(name=cache_name)
+    except Exception:
+        pass  # the cache expires on its own after CACHE_TTL_SECONDS
+
+def _generate_config(schema: dict, system_instruction: str, cache_name: str | None) -> dict:
+    config = {
+        "response_mime_type": "application/json",
+        "response_json_schema": schema,
+        "temperature": TEMPERATURE,
+    }
+    # Either way the system instruction is sent as a fixed prefix ahead of the items.
+    if cache_name is not None:
+        config["cached_content"] = cache_name
+    else:
+        config["system_instruction"] = system_instruction
+    return config
+
+def _parse_results(text: str, strict: bool) -> list[dict]:
+    """
+    The response schema fixes the field types but allows extra keys, so each record is
+    reduced to the LabeledRequest fields (KeyError if one is missing) before anything is
+    written. strict also re-validates the values against LabeledRequest, coercing types.
+    """
+    records = json.loads(text)["results"]
+    if strict:
+        return RESULTS_ADAPTER.dump_python(RESULTS_ADAPTER.validate_python(records))
+    return [{f: r[f] for f in PRED_FIELDS} for r in records]
 
+def label_one_batch(client: genai.Client, batch_items: list[dict], schema: dict,
+                    system_instruction: str, cache_name: str | None = None,
+                    strict: bool = False) -> list[dict]:
     resp = client.models.generate_content(
         model=MODEL,
-        contents=contents,
-        config={
-            "response_mime_type": "application/json",
-            "response_json_schema": schema,
-            "temperature": 0,
-        },
+        contents=build_user_contents(json.dumps(batch_items, ensure_ascii=False)),
+        config=_generate_config(schema, system_instruction, cache_name),
     )
-    return BatchResponse.model_validate_json(resp.text)
+    return _parse_results(resp.text, strict)
+
+async def label_one_batch_async(client: genai.Client, batch_items: list[dict], schema: dict,
+                                system_instruction: str, cache_name: str | None = None,
+                                strict: bool = False) -> list[dict]:
+    resp = await client.aio.models.generate_content(
+        model=MODEL,
+        contents=build_user_contents(json.dumps(batch_items, ensure_ascii=False)),
+        config=_generate_config(schema, system_instruction, cache_name),
+    )
+    return _parse_results(resp.text, strict)
+
+async def label_all_batches(client: genai.Client, batches: list[list[dict]], schema: dict,
+                            system_instruction: str, cache_name: str | None,
+                            limiter: RateLimiter, pred_fields: list[str], jsonl_file: BinaryIO,
+                            done_ids: set[int], strict: bool = False) -> int:
+    """
+    Label batches with up to MAX_CONCURRENCY calls in flight, paced by the limiter.
+    Records for ids already written, or not in the requested batch, are dropped.
+    If a call fails, no new batches start; batches already in flight are still
+    written, then the first error is re-raised.
+    Returns the number of records written.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    written_ids = set(done_ids)
+    calls_made = 0
+    new_rows = 0
+    first_error: Exception | None = None
+    progress = tqdm(total=len(batches), desc="Labeling batches")
+
+    async def run(batch: list[dict]) -> None:
+        nonlocal calls_made, new_rows, first_error
+        async with semaphore:
+            if calls_made >= DAILY_CALL_CAP or first_error is not None:
+                return
+            await limiter.acquire_async()
+            # Re-check after the wait: other tasks may have used the cap or failed meanwhile.
+            if calls_made >= DAILY_CALL_CAP or first_error is not None:
+                return
+            calls_made += 1
+            try:
+                records = await label_one_batch_async(
+                    client, batch, schema, system_instruction, cache_name, strict
+                )
+            except Exception as exc:
+                if first_error is None:
+                    first_error = exc
+                return
+            requested = {item["id"] for item in batch}
+            fresh = []
+            for r in records:
+                if r["id"] in requested and r["id"] not in written_ids:
+                    written_ids.add(r["id"])
+                    fresh.append(r)
+            records = fresh
+
+            # The appends don't await, so batches can't interleave on the event loop.
+            append_jsonl(jsonl_file, records)
+            jsonl_file.flush()
+            append_csv(str(PRED_CSV), records, pred_fields)
+            new_rows += len(records)
+            progress.update(1)
+
+    try:
+        await asyncio.gather(*(run(b) for b in batches))
+    finally:
+        progress.close()
+
+    if first_error is not None:
+        raise first_error
+    if calls_made >= DAILY_CALL_CAP and calls_made < len(batches):
+        print(f"Reached daily call cap ({DAILY_CALL_CAP}). Stop and resume tomorrow.")
+    return new_rows
 
 def main():
+    parser = argparse.ArgumentParser(description="Label the service request sample with Gemini.")
+    parser.add_argument("--strict", action="store_true",
+                        help="Validate every returned record against LabeledRequest before writing it.")
+    args = parser.parse_args()
+
     load_dotenv()
     api_key = os.environ.get("GEMINI_API_KEY")
     if not api_key:
@@ -49,7 +179,7 @@ def main():
 
     ensure_dir(str(OUT_DIR))
 
-    df = clean_text(load_csv(str(DATA)))
+    df = clean_text(load_csv_cached(str(DATA)))
     allowed_priorities = sorted(df["Priority"].dropna().unique().tolist())
     allowed_categories = sorted(df["Service Category"].dropna().unique().tolist())
 
@@ -57,7 +187,13 @@ def main():
     system_instruction = build_system_instruction(allowed_priorities, allowed_categories)
 
     client = gemini_client(api_key)
-    limiter = RateLimiter(min_seconds_between_calls=RPM_SLEEP_SECONDS)
+    limiter = RateLimiter(min_interval=RPM_SLEEP_SECONDS)
+
+    # The JSONL log is the source of truth; restore the CSV from it if it went missing.
+    pred_fields = PRED_FIELDS
+    if not PRED_CSV.exists() and PRED_JSONL.exists():
+        restored = rebuild_csv_from_jsonl(str(PRED_JSONL), str(PRED_CSV), pred_fields)
+        print(f"Rebuilt {PRED_CSV} from {PRED_JSONL} (rows: {restored})")
 
     done_ids = read_done_ids(str(PRED_CSV))
     todo = df[~df["id"].astype(int).isin(done_ids)].copy().reset_index(drop=True)
@@ -71,36 +207,21 @@ def main():
         for _, r in todo.iterrows()
     ]
 
-    calls_made = 0
-    all_records = []
-
-    for batch in tqdm(list(chunked(payload_rows, BATCH_SIZE)), desc="Labeling batches"):
-        if calls_made >= DAILY_CALL_CAP:
-            print(f"Reached daily call cap ({DAILY_CALL_CAP}). Stop and resume tomorrow.")
-            break
-
-        out = label_one_batch(client, batch, schema, system_instruction)
-        records = [x.model_dump() for x in out.results]
-
-        append_jsonl(str(PRED_JSONL), records)
-        all_records.extend(records)
-
-        calls_made += 1
-        limiter.wait()
-
-    pred_df = pd.DataFrame(all_records)
-    if pred_df.empty:
+    cache_name = create_prompt_cache(client, system_instruction)
+    try:
+        with open(PRED_JSONL, "ab", buffering=1 << 16) as jsonl_file:
+            new_rows = asyncio.run(label_all_batches(
+                client, list(chunked(payload_rows, BATCH_SIZE)), schema, system_instruction,
+                cache_name, limiter, pred_fields, jsonl_file, done_ids, args.strict,
+            ))
+    finally:
+        delete_prompt_cache(client, cache_name)
+
+    if new_rows == 0:
         print("No new predictions generated.")
         return
 
-    if PRED_CSV.exists():
-        existing = pd.read_csv(PRED_CSV)
-        combined = pd.concat([existing, pred_df], ignore_index=True).drop_duplicates(subset=["id"])
-    else:
-        combined = pred_df
-
-    combined.to_csv(PRED_CSV, index=False)
-    print(f"Saved predictions to {PRED_CSV} (rows: {len(combined)})")
+    print(f"Saved predictions to {PRED_CSV} (new rows: {new_rows})")
 
 if __name__ == "__main__":
     main()
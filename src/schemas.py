@@ -1,6 +1,9 @@
 from __future__ import annotations
+import copy
+import re
+from functools import lru_cache
 from typing import List
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 
 
 class LabeledRequest(BaseModel):
@@ -14,6 +17,9 @@ class BatchResponse(BaseModel):
     results: List[LabeledRequest]
 
 
+RESULTS_ADAPTER = TypeAdapter(List[LabeledRequest])
+
+
 def _get_defs_container(schema: dict) -> dict:
     return schema.get("$defs") or schema.get("definitions") or {}
 
@@ -30,25 +36,43 @@ def _find_labeled_request_def_key(defs: dict) -> str:
     raise KeyError("Could not find LabeledRequest in JSON Schema $defs/definitions.")
 
 
-def make_response_schema(allowed_priorities: list[str], allowed_categories: list[str]) -> dict:
-    """
-    Create a JSON schema for Gemini structured output, injecting enums.
-    """
-    schema = BatchResponse.model_json_schema()
+# Escape only ECMA-262 syntax characters; re.escape also escapes spaces and "-",
+# which JSON Schema (ECMA-262) regex engines may reject as invalid escapes.
+_REGEX_SYNTAX_CHARS = re.compile(r"([\\^$.|?*+()\[\]{}/])")
+
+
+def _alternation_pattern(values: tuple[str, ...]) -> str:
+    return "^(" + "|".join(_REGEX_SYNTAX_CHARS.sub(r"\\\1", v) for v in values) + ")$"
+
 
-    defs = _get_defs_container(schema)
-    def_key = _find_labeled_request_def_key(defs)
+_BASE_SCHEMA = BatchResponse.model_json_schema()
+_BASE_DEF_KEY = _find_labeled_request_def_key(_get_defs_container(_BASE_SCHEMA))
 
-    labeled_schema = defs[def_key]
+
+@lru_cache(maxsize=4)
+def _make_response_schema(allowed_priorities: tuple[str, ...], allowed_categories: tuple[str, ...]) -> dict:
+    schema = copy.deepcopy(_BASE_SCHEMA)
+
+    labeled_schema = _get_defs_container(schema)[_BASE_DEF_KEY]
     props = labeled_schema.get("properties")
     if not props:
-        raise KeyError(f"LabeledRequest schema for '{def_key}' has no 'properties' field.")
+        raise KeyError(f"LabeledRequest schema for '{_BASE_DEF_KEY}' has no 'properties' field.")
 
-    # Inject enums
-    props["Priority"]["enum"] = allowed_priorities
-    props["Service_Category"]["enum"] = allowed_categories
+    # Inject enums, mirrored as anchored patterns for decoders that only honour regex constraints
+    props["Priority"]["enum"] = list(allowed_priorities)
+    props["Priority"]["pattern"] = _alternation_pattern(allowed_priorities)
+    props["Service_Category"]["enum"] = list(allowed_categories)
+    props["Service_Category"]["pattern"] = _alternation_pattern(allowed_categories)
 
     # Keep actions <30 words
     props["Suggested_Actions"]["maxLength"] = 140
 
-    return schema
\ No newline at end of file
+    return schema
+
+
+def make_response_schema(allowed_priorities: list[str], allowed_categories: list[str]) -> dict:
+    """
+    Create a JSON schema for Gemini structured output, injecting enums.
+    The result is cached per label set and shared, so treat it as read-only.
+    """
+    return _make_response_schema(tuple(allowed_priorities), tuple(allowed_categories))
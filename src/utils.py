@@ -1,31 +1,140 @@
 from __future__ import annotations
 import os
-import json
+import csv
+import asyncio
 import time
-from dataclasses import dataclass
-from typing import Any, Dict, Iterator, List
+import itertools
+import threading
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List
+import orjson
 import pandas as pd
 
 @dataclass
 class RateLimiter:
-    """Simple RPM limiter."""
-    min_seconds_between_calls: float
-    def wait(self):
-        time.sleep(self.min_seconds_between_calls)
+    """RPM limiter that spaces call starts, so time spent in a call counts toward the interval."""
+    min_interval: float
+    _next_allowed: float = 0.0
+    def acquire(self):
+        now = time.monotonic()
+        if now < self._next_allowed:
+            time.sleep(self._next_allowed - now)
+        self._next_allowed = max(self._next_allowed, now) + self.min_interval
+    async def acquire_async(self):
+        # Reserve the slot before awaiting so concurrent tasks queue up behind it.
+        now = time.monotonic()
+        delay = self._next_allowed - now
+        self._next_allowed = max(self._next_allowed, now) + self.min_interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+@dataclass
+class BatchQueue:
+    """
+    Micro-batcher shared by concurrent callers.
+
+    A lone caller is sent straight through as a one-item batch. While a batch is
+    in flight, new items wait up to max_wait_ms (or until max_batch items are
+    pending) and are then sent together in a single call.
+    """
+    max_wait_ms: float = 250.0
+    max_batch: int = 50
+    pending: List[Dict[str, Any]] = field(default_factory=list)
+    _inflight: int = 0
+    _results: Dict[int, Any] = field(default_factory=dict, repr=False)
+    _ids: Iterator[int] = field(default_factory=lambda: itertools.count(1), repr=False)
+    _cond: threading.Condition = field(default_factory=threading.Condition, repr=False)
+
+    def next_id(self) -> int:
+        with self._cond:
+            return next(self._ids)
+
+    def submit(self, item: Dict[str, Any],
+               flush: Callable[[List[Dict[str, Any]]], Dict[int, Any]]) -> Any:
+        """
+        Queue one item (with a unique "id") and block until its result is ready.
+        flush receives the batch and returns results indexed by id.
+        """
+        key = item["id"]
+        with self._cond:
+            if not self.pending and self._inflight == 0:
+                batch = [item]
+            else:
+                self.pending.append(item)
+                if len(self.pending) > 1:
+                    # Another caller leads this batch; wait for it to deliver.
+                    if len(self.pending) >= self.max_batch:
+                        self._cond.notify_all()
+                    while key not in self._results:
+                        self._cond.wait()
+                    return self._pop_result(key)
+
+                deadline = time.monotonic() + self.max_wait_ms / 1000.0
+                while len(self.pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self.pending = self.pending, []
+            self._inflight += 1
+
+        try:
+            results = flush(batch)
+        except Exception as exc:
+            results = {x["id"]: exc for x in batch}
+
+        with self._cond:
+            self._inflight -= 1
+            for x in batch:
+                self._results[x["id"]] = results.get(
+                    x["id"], KeyError(f"No result returned for id {x['id']}.")
+                )
+            self._cond.notify_all()
+            return self._pop_result(key)
+
+    def _pop_result(self, key: int) -> Any:
+        result = self._results.pop(key)
+        if isinstance(result, Exception):
+            raise result
+        return result
 
 def load_csv(path: str) -> pd.DataFrame:
     return pd.read_csv(path)
 
-def clean_text(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
-    if "Service Comments" in df.columns:
-        df["Service Comments"] = df["Service Comments"].fillna("").astype(str).str.strip()
-    if "Priority" in df.columns:
-        df["Priority"] = df["Priority"].fillna("").astype(str).str.strip()
-    if "Service Category" in df.columns:
-        df["Service Category"] = df["Service Category"].fillna("").astype(str).str.strip()
+def load_csv_cached(path: str, usecols: List[str] | None = None) -> pd.DataFrame:
+    """
+    Read a CSV through a sibling .parquet cache that is rebuilt whenever the CSV is newer.
+    usecols is applied as a Parquet column projection; the cache itself keeps every column.
+    Raises KeyError if a requested column is missing.
+    """
+    csv_path = Path(path)
+    parquet_path = csv_path.with_suffix(".parquet")
+    if parquet_path.exists() and parquet_path.stat().st_mtime >= csv_path.stat().st_mtime:
+        try:
+            return pd.read_parquet(parquet_path, engine="pyarrow", columns=usecols, use_threads=True)
+        except (OSError, ValueError):
+            pass  # unreadable cache or missing column; fall back to the CSV
+
+    df = pd.read_csv(csv_path)
+    try:
+        df.to_parquet(parquet_path, engine="pyarrow", index=False)
+    except (OSError, ValueError):
+        pass  # read-only deploys just skip the cache
+    return df[usecols].copy() if usecols is not None else df
+
+def normalize_str_cols(df: pd.DataFrame, cols: List[str]) -> pd.DataFrame:
+    """
+    Return a copy with cols as stripped pyarrow-backed strings (missing -> "").
+    """
+    df = df.astype({col: "string[pyarrow]" for col in cols})
+    df[cols] = df[cols].fillna("").apply(lambda s: s.str.strip())
     return df
 
+def clean_text(df: pd.DataFrame) -> pd.DataFrame:
+    cols = [c for c in ("Service Comments", "Priority", "Service Category") if c in df.columns]
+    return normalize_str_cols(df, cols)
+
 def chunked(seq: List[Any], n: int) -> Iterator[List[Any]]:
     for i in range(0, len(seq), n):
         yield seq[i:i+n]
@@ -36,13 +145,48 @@ def ensure_dir(path: str) -> None:
 def read_done_ids(pred_csv_path: str) -> set[int]:
     if not os.path.exists(pred_csv_path):
         return set()
-    try:
-        df = pd.read_csv(pred_csv_path)
-        return set(df["id"].astype(int).tolist()) if "id" in df.columns else set()
-    except Exception:
-        return set()
+    done: set[int] = set()
+    with open(pred_csv_path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header or "id" not in header:
+            return done
+        idx = header.index("id")
+        for row in reader:
+            try:
+                done.add(int(row[idx]))
+            except (IndexError, ValueError):
+                continue  # skip blank or malformed rows
+    return done
+
+def append_jsonl(f: BinaryIO, records: List[Dict[str, Any]]) -> None:
+    """Write records to a file opened in binary append mode; the caller flushes."""
+    f.write(b"".join(orjson.dumps(r) + b"\n" for r in records))
+
+def append_csv(path: str, records: List[Dict[str, Any]], fieldnames: List[str]) -> None:
+    write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, lineterminator="\n", extrasaction="ignore")
+        if write_header:
+            writer.writeheader()
+        writer.writerows(records)
 
-def append_jsonl(path: str, records: List[Dict[str, Any]]) -> None:
-    with open(path, "a", encoding="utf-8") as f:
-        for r in records:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+def rebuild_csv_from_jsonl(jsonl_path: str, csv_path: str, fieldnames: List[str]) -> int:
+    """
+    Rewrite the CSV from the JSONL log (first record per id wins). Returns rows written.
+    Extra keys are ignored and records without an id are skipped.
+    """
+    seen: set[int] = set()
+    with open(jsonl_path, "r", encoding="utf-8") as src, \
+            open(csv_path, "w", encoding="utf-8", newline="") as dst:
+        writer = csv.DictWriter(dst, fieldnames=fieldnames, lineterminator="\n", extrasaction="ignore")
+        writer.writeheader()
+        for line in src:
+            if not line.strip():
+                continue
+            r = orjson.loads(line)
+            if "id" not in r or r["id"] in seen:
+                continue
+            seen.add(r["id"])
+            writer.writerow(r)
+    return len(seen)